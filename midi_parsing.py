@@ -0,0 +1,111 @@
+""" Functions related to MIDI file parsing """
+
+import struct
+
+# number of data bytes following each status byte, None for undefined status bytes
+# (meta, sysex and running status are handled separately)
+_DATA_LENGTHS = [None] * 0x80 + [1 if 0xc0 <= s < 0xe0 else 2 for s in range(0x80, 0xf0)] + \
+                [None, 1, 2, 1, None, None, 0, None, 0, None, 0, 0, 0, None, 0, None]
+
+
+def read_midi(filename):
+    # reads a standard MIDI file, returns its ticks per beat and an iterator of events for each track
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    # chunk headers are 8 bytes (name and size) and the MThd data is at least 6 bytes
+    if len(data) < 8:
+        raise EOFError
+    name, size = struct.unpack_from(">4sL", data, 0)
+    if name != b"MThd":
+        raise OSError("MThd not found. Probably not a MIDI file")
+    if size < 6 or len(data) < 14:
+        raise EOFError
+    _, num_tracks, ticks_per_beat = struct.unpack_from(">hhh", data, 8)
+
+    tracks = []
+    pos = 8 + size
+    for _ in range(num_tracks):
+        if pos + 8 > len(data):
+            raise EOFError
+        name, size = struct.unpack_from(">4sL", data, pos)
+        if name != b"MTrk":
+            raise OSError("no MTrk header at start of track")
+        pos += 8
+        if pos + size > len(data):
+            raise EOFError
+        tracks.append(track_events(data[pos:pos + size]))
+        pos += size
+
+    return ticks_per_beat, tracks
+
+
+def track_events(track):
+    # yields (delta time, status, payload) for each event in the raw data of a track, where payload is the first
+    # data byte for channel messages (the note for note events), a (meta type, data) tuple for meta messages and
+    # None otherwise. No mido message is built, meta messages can be decoded with decode_meta when needed.
+    pos = 0
+    end = len(track)
+    last_status = None
+    while pos < end:
+        try:
+            # delta time, read inline instead of through _read_variable_int since every event starts with one
+            delta = 0
+            byte = 0x80
+            while byte & 0x80:
+                byte = track[pos]
+                pos += 1
+                delta = (delta << 7) | (byte & 0x7f)
+
+            status = track[pos]
+            if status < 0x80:
+                if last_status is None:
+                    raise OSError("running status without last_status")
+                status = last_status
+            else:
+                pos += 1
+                if status != 0xff:
+                    # meta messages don't set running status
+                    last_status = status
+
+            if status == 0xff:
+                meta_type = track[pos]
+                pos, length = _read_variable_int(track, pos + 1)
+                payload = (meta_type, track[pos:pos + length])
+                pos += length
+            elif status == 0xf0 or status == 0xf7:
+                pos, length = _read_variable_int(track, pos)
+                pos += length
+                payload = None
+            else:
+                length = _DATA_LENGTHS[status]
+                if length is None:
+                    raise OSError(f"undefined status byte 0x{status:02x}")
+                # out of range data bytes are clipped, like mido does with clip=True
+                payload = min(track[pos], 0x7f) if length else None
+                pos += length
+        except IndexError:
+            # the track ends in the middle of a delta time, status byte or length
+            raise EOFError from None
+        if pos > end:
+            # the track ends in the middle of the event data
+            raise EOFError
+
+        yield delta, status, payload
+
+
+def decode_meta(meta_type, data):
+    # builds the mido message of a meta event from its type and data, like mido's own file reader does
+    # (mido is imported here so that it's only loaded once a meta event is actually needed)
+    from mido.midifiles.meta import build_meta_message
+    return build_meta_message(meta_type, data)
+
+
+def _read_variable_int(data, pos):
+    value = 0
+    byte = 0x80
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+    return pos, value
@@ -36,10 +36,14 @@ Nomenclature:
 
 """
 
-import mido
-from docopt import docopt
+import heapq
+import sys
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
 
 from arg_parsing import *
+from midi_parsing import decode_meta, read_midi
 
 arg_parsers = {
     "--hands": int_parser(minv=1),
@@ -52,36 +56,39 @@ arg_parsers = {
 
 
 # utility functions
-def m2h_note(note):
-    # TODO: support different keys
-    pitches = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    octave = (note // 12) - 1
-    pitch = pitches[note % 12]
-    return pitch + str(octave)
+# TODO: support different keys
+_PITCHES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+_NOTE_NAMES = tuple(_PITCHES[note % 12] + str((note // 12) - 1) for note in range(128))
 
 
-def white_key_index(note):
-    key_index = [0, 0.5, 1, 1.5, 2, 3, 3.5, 4, 4.5, 5, 5.5, 6]
-    octave = note // 12
-    key = note % 12
-    index = octave * 7 + key_index[key]
-    return index
+def m2h_note(note):
+    if 0 <= note < 128:
+        return _NOTE_NAMES[note]
+    # only reachable for the key range arguments, which aren't bound to valid MIDI notes
+    return _PITCHES[note % 12] + str((note // 12) - 1)
 
 
-def key_distance(n1, n2):
-    return white_key_index(n2) - white_key_index(n1)
+# position of each MIDI note (0-127) counting white keys, black keys sit halfway between two white keys.
+# Positions are stored doubled so that they are integers.
+_KEY_INDEX_X2 = (0, 1, 2, 3, 4, 6, 7, 8, 9, 10, 11, 12)
+_WHITE_KEY_INDEX_X2 = tuple((note // 12) * 14 + _KEY_INDEX_X2[note % 12] for note in range(128))
 
 
-def midi_time_to_seconds(time, ppqn, tempo):
-    return mido.tick2second(time, ppqn, tempo)
+def mask_to_notes(mask):
+    # returns the notes whose bits are set in the mask, in ascending order
+    notes = []
+    while mask:
+        lsb = mask & -mask
+        notes.append(lsb.bit_length() - 1)
+        mask ^= lsb
+    return notes
 
 
-def midi_time_to_measure(time, ppqn, timesig):
-    beat = time / ppqn
-    beats_per_measure = 4 * (timesig[0] / timesig[1])
-    measure = 1 + int(beat / beats_per_measure)
+# microseconds per quarter note when the MIDI doesn't set a tempo (120 BPM, same as mido.midifiles.DEFAULT_TEMPO)
+_DEFAULT_TEMPO = 500000
 
-    return measure
+# maps docopt arg names to attribute names, e.g. "--max-notes" -> "__max_notes" (then stripped) and "<file>" -> "file"
+_ARG_NAME_TABLE = str.maketrans({"-": "_", "<": None, ">": None})
 
 
 class Config:
@@ -95,8 +102,7 @@ class Config:
 
     def __init__(self, args):
         # hack to automatically convert command line args to config attributes
-        self.__dict__ = {k.replace("--", "").replace("<", "").replace(">", "").replace("-", "_"): v for k, v in
-                         args.items()}
+        self.__dict__ = {k.translate(_ARG_NAME_TABLE).lstrip("_"): v for k, v in args.items()}
 
         # extra attributes that don't come from the command line
         self.tempo = None
@@ -106,128 +112,235 @@ class Config:
 
         # functions
         self.note2str = str if self.no_note_trans else m2h_note
-        self.time2str = str if self.no_time_trans else lambda t: str(
-            midi_time_to_seconds(t, self.ppqn, self.tempo)) + "s"
-
+        self.time2str = str
+        self.time2measure = None
 
-class Action:
-    """ A class which represents an action performed on the piano """
+    def set_time_factors(self):
+        # sets up the MIDI time conversions, must be called once the MIDI metadata has been read
+        # (tempo and time signature default to 120 BPM and 4/4 as in the MIDI standard)
+        if self.tempo is None:
+            self.tempo = _DEFAULT_TEMPO
+        beats_per_measure = 4 * self.timesig[0] / self.timesig[1] if self.timesig is not None else 4
+        ticks_per_measure = self.ppqn * beats_per_measure
+        self.time2measure = lambda t: 1 + int(t / ticks_per_measure)
+        if not self.no_time_trans:
+            # same conversion as mido.tick2second, for a fixed tempo and ppqn
+            sec_per_tick = self.tempo * 1e-6 / self.ppqn
+            self.time2str = lambda t: str(t * sec_per_tick) + "s"
 
-    def __init__(self, press, note, time, config):
-        self.press = press
-        self.note = note
-        self.time = time
-        self.config = config
 
-    def __str__(self):
-        action_str = "Press" if self.press else "Release"
-        note_str = self.config.note2str(self.note)
-        time_str = self.config.time2str(self.time)
-        measure = midi_time_to_measure(self.time, self.config.ppqn, self.config.timesig)
-        return f"{action_str} note {note_str} at measure {measure} ({time_str})"
+def format_action(press, note, time, config):
+    # human readable description of an action performed on the piano, only built for the actions which get printed
+    return f"{'Press' if press else 'Release'} note {config.note2str(note)} " \
+           f"at measure {config.time2measure(time)} ({config.time2str(time)})"
 
 
 class MidiChecker:
     def __init__(self, config):
         # opens midi file and sets up some variables
-        self.midi = mido.MidiFile(config.file)
+        ticks_per_beat, self.tracks = read_midi(config.file)
         self.config = config
-        self.config.ppqn = self.midi.ticks_per_beat
+        self.config.ppqn = ticks_per_beat
+
+        # bitmask of the notes outside the piano range
+        keys_below_highest = (1 << max(config.highest_key + 1, 0)) - 1
+        keys_below_lowest = (1 << max(config.lowest_key, 0)) - 1
+        self._out_of_range_mask = ~(keys_below_highest & ~keys_below_lowest)
+
+        # notes assigned to each hand by the last hands & fingers check, and the bitmask of those notes.
+        # The buffers are allocated once with room for every finger, only the first num_hands hands and the
+        # first hand_counts[h] notes of each hand are in use. At most 128 notes can be held, so neither more
+        # hands nor more fingers per hand than that are ever used.
+        max_hands = min(config.hands, 128)
+        self._hand_keys = [array("B", bytes(min(config.fingers, 128))) for _ in range(max_hands)]
+        self._hand_counts = [0] * max_hands
+        # doubled white key index of the highest key each hand can reach from its lowest key
+        self._hand_reach = [0] * max_hands
+        self._num_hands = 0
+        self._hand_mask = 0
+
+        # check of the enabled restrictions, None if all of them are disabled
+        self._check_restrictions = self._make_check_restrictions()
+        # pressed notes and result of the last restrictions check
+        self._last_mask = -1
+        self._last_result = None
 
     def parse_events(self):
-        # creates a list of actions (press/release note) with their associated timestamp
-        actions = []
-        for i, track in enumerate(self.midi.tracks):
-            acc_time = 0
-            for msg in track:
-                # assume MIDI song metadata is at some event at time 0
-                # TODO: for now, assume tempo and time sig don't change for the whole song
-                if msg.time == 0:
-                    if msg.type == "set_tempo":
-                        self.config.tempo = msg.tempo
-                    elif msg.type == "key_signature":
-                        self.config.key = msg.key
-                    elif msg.type == "time_signature":
-                        self.config.timesig = (msg.numerator, msg.denominator)
-
-                acc_time += msg.time
-                if msg.type in ["note_on", "note_off"]:
-                    actions.append(Action(msg.type == "note_on", msg.note, acc_time, self.config))
-
-        # sort actions by acc time (needed if the midi has more than one track)
-        actions.sort(key=lambda a: a.time)
-
-        return actions
+        # creates the list of actions (press/release note) with their associated timestamp, stored as
+        # three parallel arrays (press flag, note, time) instead of one object per action
+        presses = array("B")
+        notes = array("B")
+        times = array("Q")
+        # each track is already sorted by time, so they are merged instead of sorting all the actions (needed if
+        # the midi has more than one track). The merge is stable, so simultaneous actions keep their track order.
+        for time, press, note in heapq.merge(*map(self._track_actions, self.tracks), key=itemgetter(0)):
+            presses.append(press)
+            notes.append(note)
+            times.append(time)
+
+        self.config.set_time_factors()
+
+        return presses, notes, times
+
+    def _track_actions(self, track):
+        # yields the (time, press, note) actions of a track, in order
+        acc_time = 0
+        for delta, status, payload in track:
+            acc_time += delta
+            # note events are by far the most common, so they are checked first
+            kind = status & 0xf0
+            if kind == 0x90 or kind == 0x80:
+                yield acc_time, kind == 0x90, payload
+            # assume MIDI song metadata is at some event at time 0
+            # TODO: for now, assume tempo and time sig don't change for the whole song
+            elif status == 0xff and delta == 0:
+                meta = decode_meta(*payload)
+                if meta.type == "set_tempo":
+                    self.config.tempo = meta.tempo
+                elif meta.type == "key_signature":
+                    self.config.key = meta.key
+                elif meta.type == "time_signature":
+                    self.config.timesig = (meta.numerator, meta.denominator)
 
     def verify_actions(self, actions):
         # analizes all note intersections to determine if they are playable with the given restrictions
+        config = self.config
+        hide_warnings = config.hide_warnings
+        abort_on_fail = config.abort_on_fail
+        # when all restrictions are disabled (see _make_check_restrictions) only the warnings are checked
+        check_restrictions = self._check_restrictions is not None
+        verify_restrictions = self._verify_restrictions
+        # messages go straight to the stdout buffer, with a single write per message
+        write = sys.stdout.write
+        indent = "      "
+
         no_fails = True
-        pressed_notes = []
-        for a in actions:
-            if a.press:
-                if a.note in pressed_notes:
-                    if not self.config.hide_warnings:
-                        print(f"Warning: Note press while note is already being pressed, in action '{a}'")
+        # pressed notes are stored as a bitmask (bit n set = note n pressed), MIDI notes are in range 0-127
+        pressed_mask = 0
+        # actions are only formatted when they get printed
+        for press, note, time in zip(*actions):
+            note_bit = 1 << note
+            if press:
+                if pressed_mask & note_bit:
+                    if not hide_warnings:
+                        a = format_action(press, note, time, config)
+                        write(f"Warning: Note press while note is already being pressed, in action '{a}'\n")
                 else:
-                    pressed_notes.append(a.note)
-                violation = self._verify_restrictions(pressed_notes)
-                if violation is not None:
-                    print(f"Fail: Restrictions not satisfied, in action '{a}'")
-                    indent = "      "
-                    print(indent + violation.replace("\n", "\n" + indent))
-                    no_fails = False
-                    if self.config.abort_on_fail:
-                        exit(1)
+                    pressed_mask |= note_bit
+                if check_restrictions:
+                    violation = verify_restrictions(pressed_mask)
+                    if violation is not None:
+                        a = format_action(press, note, time, config)
+                        violation = indent + violation.replace("\n", "\n" + indent)
+                        write(f"Fail: Restrictions not satisfied, in action '{a}'\n{violation}\n")
+                        no_fails = False
+                        if abort_on_fail:
+                            exit(1)
             else:
-                if a.note not in pressed_notes:
-                    if not self.config.hide_warnings:
-                        print(f"Warning: Note release while note is not being pressed, in action '{a}'")
+                if not pressed_mask & note_bit:
+                    if not hide_warnings:
+                        a = format_action(press, note, time, config)
+                        write(f"Warning: Note release while note is not being pressed, in action '{a}'\n")
                 else:
-                    pressed_notes.remove(a.note)
+                    pressed_mask &= ~note_bit
 
         if no_fails:
-            print("All tests passed!")
+            write("All tests passed!\n")
+
+    def _verify_restrictions(self, pressed_mask):
+        # the result only depends on the pressed notes, repeated chords (e.g. trills) reuse the last result
+        if pressed_mask == self._last_mask:
+            return self._last_result
+        self._last_mask = pressed_mask
+        self._last_result = self._check_restrictions(pressed_mask)
+        return self._last_result
+
+    def _make_check_restrictions(self):
+        # the enabled restrictions don't change during the run, so the check is put together once with only those.
+        # Returns None if there's nothing to check, then verify_actions doesn't check restrictions at all.
+        checks = []
+        if not self.config.no_piano_res:
+            checks.append(self._check_piano_restrictions)
+        if not self.config.no_player_res:
+            checks.append(self._check_player_restrictions)
 
-    def _verify_restrictions(self, pressed_notes):
-        sorted_pressed_notes = sorted(pressed_notes)
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+        check_piano_restrictions, check_player_restrictions = checks
+        return lambda pressed_mask: check_piano_restrictions(pressed_mask) or check_player_restrictions(pressed_mask)
 
-        # piano restrictions
-        if not self.config.no_piano_res:
-            # note range check
-            for n in pressed_notes:
-                if not self.config.lowest_key <= n <= self.config.highest_key:
-                    return f"Note out of range. Must be between {self.config.note2str(self.config.lowest_key)} and {self.config.note2str(self.config.highest_key)}."
+    def _check_piano_restrictions(self, pressed_mask):
+        config = self.config
 
-        # player restrictions
-        if not self.config.no_player_res:
-            # max notes check
-            if len(pressed_notes) > self.config.max_notes:
-                return f"Too many notes held at once ({len(pressed_notes)}), maximum is {self.config.max_notes}.\n" \
-                       f"Notes pressed at once: {', '.join(map(self.config.note2str, sorted_pressed_notes))}."
-
-            # hands & fingers check (assumes min 1 hand and 1 finger per hand)
-            hand_keys = [[sorted_pressed_notes[0]]]
-            hand = 0
-            for n in sorted_pressed_notes[1:]:
-                if len(hand_keys[hand]) == self.config.fingers or key_distance(hand_keys[hand][0],
-                                                                               n) > self.config.span:
-                    hand += 1
-                    if hand == self.config.hands:
-                        hand_keys_str = '\n'.join(
-                            f"Hand {h}: {', '.join(map(self.config.note2str, hand_keys[h]))}." for h in
-                            range(self.config.hands))
-                        return f"Not enough hands/fingers to press all the keys. Keys pressed by each hand:\n" \
-                               f"{hand_keys_str}\n" \
-                               f"Then trying to also hold {self.config.note2str(n)}."
-                    hand_keys.append([n])
+        # note range check
+        if pressed_mask & self._out_of_range_mask:
+            return f"Note out of range. Must be between {config.note2str(config.lowest_key)} and {config.note2str(config.highest_key)}."
+
+        return None
+
+    def _check_player_restrictions(self, pressed_mask):
+        config = self.config
+        hands = config.hands
+        fingers = config.fingers
+        span_x2 = config.span * 2
+        white_key_index_x2 = _WHITE_KEY_INDEX_X2
+        max_notes = config.max_notes
+
+        # max notes check
+        num_pressed = bin(pressed_mask).count("1")
+        if num_pressed > max_notes:
+            return f"Too many notes held at once ({num_pressed}), maximum is {max_notes}.\n" \
+                   f"Notes pressed at once: {', '.join(map(config.note2str, mask_to_notes(pressed_mask)))}."
+
+        # hands & fingers check (assumes min 1 hand and 1 finger per hand)
+        # notes are greedily assigned to hands from lowest to highest, so the assignment of a note only
+        # depends on the notes below it. The assignment from the previous call is kept for the notes below
+        # the lowest note which changed since then, and only the notes from there upwards are walked again.
+        hand_keys = self._hand_keys
+        hand_counts = self._hand_counts
+        hand_reach = self._hand_reach
+        num_hands = self._num_hands
+        changed = pressed_mask ^ self._hand_mask
+        if changed:
+            lowest_changed = (changed & -changed).bit_length() - 1
+            while num_hands and hand_keys[num_hands - 1][0] >= lowest_changed:
+                num_hands -= 1
+            if num_hands:
+                last_hand = num_hands - 1
+                hand_counts[last_hand] = bisect_left(hand_keys[last_hand], lowest_changed, 0,
+                                                     hand_counts[last_hand])
+
+            for n in mask_to_notes(pressed_mask >> lowest_changed << lowest_changed):
+                hand = num_hands - 1
+                if num_hands and hand_counts[hand] < fingers and white_key_index_x2[n] <= hand_reach[hand]:
+                    hand_keys[hand][hand_counts[hand]] = n
+                    hand_counts[hand] += 1
+                elif num_hands < hands:
+                    hand_keys[num_hands][0] = n
+                    hand_counts[num_hands] = 1
+                    hand_reach[num_hands] = white_key_index_x2[n] + span_x2
+                    num_hands += 1
                 else:
-                    hand_keys[hand].append(n)
+                    # the assignment is only valid for the notes below the one which didn't fit
+                    self._num_hands = num_hands
+                    self._hand_mask = pressed_mask & ((1 << n) - 1)
+                    hand_keys_str = '\n'.join(
+                        f"Hand {h}: {', '.join(map(config.note2str, hand_keys[h][:hand_counts[h]]))}."
+                        for h in range(hands))
+                    return f"Not enough hands/fingers to press all the keys. Keys pressed by each hand:\n" \
+                           f"{hand_keys_str}\n" \
+                           f"Then trying to also hold {config.note2str(n)}."
+            self._num_hands = num_hands
+            self._hand_mask = pressed_mask
 
         return None
 
 
 def main():
     # automatic arg parsing from module docstring
+    from docopt import docopt
     args = docopt(__doc__)
     if args["<file>"] is None:
         print(__doc__)